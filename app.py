@@ -1,15 +1,37 @@
 import os
+import re
+import glob
 import json
 import time
+import heapq
+import queue
+import atexit
+import signal
 import secrets
-from datetime import datetime
-from urllib.parse import urlparse
+import threading
+import itertools
+import contextvars
+import fcntl
+from contextlib import contextmanager
+from functools import lru_cache
+from collections import OrderedDict, namedtuple
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, jsonify, redirect
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import uuid
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlparse, parse_qs
+
+try:
+    import orjson  # optional: much faster JSON; stdlib json is used when it's not installed
+except ImportError:
+    orjson = None
 
 # =========================
 # Config from Environment
@@ -21,6 +43,7 @@ AMO_REDIRECT_URI = (os.environ.get("AMO_REDIRECT_URI") or os.environ.get("AMO_RE
 # Telegram (accept both naming styles)
 TG_BOT_TOKEN = (os.environ.get("TG_BOT_TOKEN") or os.environ.get("TELEGRAM_BOT_TOKEN") or "").strip()
 TG_CHAT_ID = (os.environ.get("TG_CHAT_ID") or os.environ.get("TELEGRAM_CHAT_ID") or "").strip()
+TG_SEND_URL = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMessage" if TG_BOT_TOKEN else ""
 
 # amo auth page for RU region
 AMO_AUTH_URL = "https://www.amocrm.ru/oauth"
@@ -29,6 +52,23 @@ AMO_AUTH_URL = "https://www.amocrm.ru/oauth"
 DEFAULT_LIMIT = 100
 MAX_STALE_ACTIVITY_CHECK = int(os.environ.get("MAX_STALE_ACTIVITY_CHECK") or "200")  # max leads for deep check per request
 HTTP_TIMEOUT = int(os.environ.get("HTTP_TIMEOUT") or "35")
+# Refresh access token in background when it expires within this window
+TOKEN_REFRESH_AHEAD_SEC = int(os.environ.get("TOKEN_REFRESH_AHEAD_SEC") or "300")
+# A background thread checks stored tokens this often and refreshes the ones about to expire (0 = off)
+TOKEN_SWEEP_SEC = int(os.environ.get("TOKEN_SWEEP_SEC") or "60")
+# Concurrent amo calls per /report/dashboard request (keep low: amo rate-limits per integration)
+REPORT_FETCH_WORKERS = int(os.environ.get("REPORT_FETCH_WORKERS") or "4")
+# Hard cap on in-flight amo API calls per account across all threads/pools of this process
+AMO_MAX_CONCURRENCY = int(os.environ.get("AMO_MAX_CONCURRENCY") or "4")
+# users / loss reasons change rarely: keep them per subdomain for this long (?refresh=1 bypasses)
+DICT_CACHE_TTL_SEC = int(os.environ.get("DICT_CACHE_TTL_SEC") or "300")
+DICT_CACHE_MAX = 256
+# Finished dashboard bodies are reused for identical queries this long (0 = off; ?nocache=1 bypasses)
+REPORT_CACHE_TTL_SEC = int(os.environ.get("REPORT_CACHE_TTL_SEC") or "30")
+REPORT_CACHE_MAX = 64
+CLOSED_STATUSES = frozenset((142, 143))  # amo system statuses: won / lost
+LOST_STATUS = 143
+
 # Event types we consider as 'activity' for stale-deals detection
 RELEVANT_EVENT_TYPES = [
   "task_added",
@@ -80,81 +120,481 @@ TOKENS_FILE = os.path.join(DATA_DIR, "tokens.json")   # by subdomain
 STATES_FILE = os.path.join(DATA_DIR, "states.json")   # oauth states mapping
 
 STATE_TTL_SEC = 15 * 60
+# Coalesce tokens/states writes: flush to disk at most once per this many seconds
+STORE_FLUSH_DELAY_SEC = float(os.environ.get("STORE_FLUSH_DELAY_SEC") or "1")
+
+# Shared HTTP session: keep-alive connections to amo/Telegram are reused across calls.
+# Retry only covers idempotent methods (urllib3 default), so token POSTs are never replayed;
+# 429 retries honour amo's Retry-After.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=50,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504], raise_on_status=False),
+    ),
+)
+_SESSION.headers["User-Agent"] = "loss-control/1.0"
+atexit.register(_SESSION.close)
+
+class _OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (jsonify, request.get_json)."""
+
+    # keep insertion order: sorting every response dict costs more than it's worth for API clients
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        try:
+            # NaN/Infinity come out as null here (stdlib json wrote bare NaN, which isn't JSON)
+            return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+        except TypeError:  # orjson.JSONEncodeError, e.g. integers wider than 64 bits
+            return super().dumps(obj, **kwargs)
+
+    # orjson turns integers wider than 64 bits into floats: any 19+ digit run goes to stdlib json
+    _LONG_DIGITS = re.compile(r"\d{19,}")
+    _LONG_DIGITS_B = re.compile(rb"\d{19,}")
+
+    def loads(self, s, **kwargs):
+        long_digits = self._LONG_DIGITS_B if isinstance(s, (bytes, bytearray)) else self._LONG_DIGITS
+        if not long_digits.search(s):
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                pass  # NaN/Infinity and other input only stdlib json accepts (or to raise its error)
+        return super().loads(s, **kwargs)
+
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = _OrjsonProvider(app)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
 # =========================
 # Helpers
 # =========================
-def _now_iso() -> str:
-    return datetime.utcnow().isoformat() + "Z"
+_ISO_SECOND = (None, "")  # (whole second, its "YYYY-MM-DDTHH:MM:SS" prefix)
+
+
+def _now_iso(ts: float = None) -> str:
+    global _ISO_SECOND
+    if ts is None:
+        ts = time.time()
+    sec = int(ts)
+    cached = _ISO_SECOND
+    if cached[0] != sec:
+        # events come in bursts: format the date/time part once per second
+        cached = _ISO_SECOND = (sec, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec)))
+    return f"{cached[1]}.{int((ts - sec) * 1e6):06d}Z"
+
+
+_DATA_DIR_READY = False
+
+
+def _ensure_data_dir(force: bool = False):
+    # DATA_DIR is fixed: one makedirs per process, unless a write found it missing (force)
+    global _DATA_DIR_READY
+    if force or not _DATA_DIR_READY:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        _DATA_DIR_READY = True
+
+
+def _json_default(obj):
+    # slotted dataclasses (LeadOut) for the stdlib fallback; orjson encodes them natively
+    if hasattr(obj, "__dataclass_fields__"):
+        return {k: getattr(obj, k) for k in obj.__dataclass_fields__}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
-def _ensure_data_dir():
-    os.makedirs(DATA_DIR, exist_ok=True)
+def _json_dumps(obj, default=None) -> bytes:
+    """Compact UTF-8 JSON bytes (non-ASCII kept as is). default: fallback for unsupported values."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # e.g. integers wider than 64 bits: orjson raises before trying default
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default or _json_default).encode("utf-8")
+
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 def _load_json(path: str, default):
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return _json_loads(f.read())
     except Exception:
         return default
 
 
 def _save_json(path: str, data):
     _ensure_data_dir()
+    buf = memoryview(_json_dumps(data))
     tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    except FileNotFoundError:
+        _ensure_data_dir(force=True)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        while buf:
+            buf = buf[os.write(fd, buf):]
+    finally:
+        os.close(fd)
     os.replace(tmp, path)
     return True
 
 
-def log_event(event_type: str, payload: dict):
-    record = {"ts": _now_iso(), "event": event_type, "payload": payload}
+# Events are queued by log_event and appended to EVENTS_FILE in batches by one writer thread.
+# The writer keeps a long-lived O_APPEND fd (one os.write per batch), reopened if the file
+# is rotated/removed.
+LOG_QUEUE_MAX = 10000
+LOG_BATCH_MAX = 256
+LOG_BATCH_LINGER_SEC = 0.005  # after the first record, wait this long for more to join the batch
+_LOG_Q = queue.Queue(maxsize=LOG_QUEUE_MAX)
+# Comma-separated event types not to record at all, e.g. LOG_SKIP_EVENTS=ping
+LOG_SKIP_EVENTS = frozenset(e.strip() for e in os.environ.get("LOG_SKIP_EVENTS", "").split(",") if e.strip())
+# Rotate events.jsonl past this size (0 = never); keep this many rotated files
+EVENTS_MAX_BYTES = int(os.environ.get("EVENTS_MAX_BYTES") or str(32 * 1024 * 1024))
+EVENTS_KEEP_ROTATED = int(os.environ.get("EVENTS_KEEP_ROTATED") or "5")
+# Event lines longer than this have their payload replaced by a truncated preview
+EVENT_LINE_MAX_BYTES = int(os.environ.get("EVENT_LINE_MAX_BYTES") or "8192")
+_EVENTS_FD = None
+_EVENTS_ID = None  # (st_dev, st_ino) of the opened file
+_EVENTS_LOCK = threading.Lock()
+
+
+def _events_fd() -> int:
+    global _EVENTS_FD, _EVENTS_ID
     try:
-        _ensure_data_dir()
-        with open(EVENTS_FILE, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
-    except Exception:
+        st = os.stat(EVENTS_FILE)
+        cur_id = (st.st_dev, st.st_ino)
+    except FileNotFoundError:
+        cur_id = None
+    if _EVENTS_FD is None or cur_id != _EVENTS_ID:
+        if _EVENTS_FD is not None:
+            try:
+                os.close(_EVENTS_FD)
+            except OSError:
+                pass
+            _EVENTS_FD = None
+        _ensure_data_dir(force=cur_id is None)
+        _EVENTS_FD = os.open(EVENTS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        st = os.fstat(_EVENTS_FD)
+        _EVENTS_ID = (st.st_dev, st.st_ino)
+    return _EVENTS_FD
+
+
+def _events_rotate_if_needed(fd: int):
+    """Called with _EVENTS_LOCK held, after a write. The next _events_fd() reopens a fresh file."""
+    if EVENTS_MAX_BYTES <= 0 or os.fstat(fd).st_size < EVENTS_MAX_BYTES:
+        return
+    try:
+        # another worker may have rotated already: check the path, not just our fd
+        if os.stat(EVENTS_FILE).st_size < EVENTS_MAX_BYTES:
+            return
+        os.replace(EVENTS_FILE, f"{EVENTS_FILE}.{datetime.now(timezone.utc):%Y%m%d-%H%M%S}")
+        for old in sorted(glob.glob(EVENTS_FILE + ".*"))[:-EVENTS_KEEP_ROTATED or None]:
+            os.remove(old)
+    except OSError:
         pass
 
 
-def _states_get(state: str):
-    if not state:
-        return None
-    states = _load_json(STATES_FILE, {})
-    item = states.get(state)
-    if not item:
-        return None
-    if int(time.time()) - int(item.get("ts", 0)) > STATE_TTL_SEC:
+def _events_write(batch: list):
+    lines = []
+    for ts, event_type, payload in batch:
         try:
-            states.pop(state, None)
-            _save_json(STATES_FILE, states)
+            record = {"ts": _now_iso(ts), "event": event_type, "payload": payload}
+            # str() stray values (exceptions, datetimes, ...) rather than lose the event
+            line = _json_dumps(record, default=str)
+            if len(line) > EVENT_LINE_MAX_BYTES:
+                raw = _json_dumps(payload, default=str)
+                record["payload"] = {
+                    "_truncated": True,
+                    "len": len(raw),
+                    "head": raw[:512].decode("utf-8", errors="replace"),
+                }
+                line = _json_dumps(record, default=str)
+            lines.append(line + b"\n")
         except Exception:
             pass
+    if not lines:
+        return
+    try:
+        with _EVENTS_LOCK:
+            fd = _events_fd()
+            buf = memoryview(b"".join(lines))
+            while buf:
+                buf = buf[os.write(fd, buf):]
+            _events_rotate_if_needed(fd)
+    except Exception:
+        pass
+
+
+_LOG_STOP = object()  # queued by _log_drain: writer flushes what it has and exits
+_LOG_DROPPED = 0  # events lost to a full queue since the writer last reported (approximate)
+
+
+def _log_dropped_record():
+    """An events_dropped record for the next batch if log_event had to drop any, else None."""
+    global _LOG_DROPPED
+    n, _LOG_DROPPED = _LOG_DROPPED, 0
+    return (time.time(), "events_dropped", {"count": n}) if n else None
+
+
+def _log_writer():
+    while True:
+        batch = [_LOG_Q.get()]
+        deadline = time.monotonic() + LOG_BATCH_LINGER_SEC
+        while len(batch) < LOG_BATCH_MAX and batch[-1] is not _LOG_STOP:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(_LOG_Q.get(timeout=timeout) if timeout > 0 else _LOG_Q.get_nowait())
+            except queue.Empty:
+                break
+        stop = batch[-1] is _LOG_STOP
+        if stop:
+            batch.pop()
+        dropped = _log_dropped_record()
+        if dropped:
+            batch.append(dropped)
+        _events_write(batch)
+        if stop:
+            return
+
+
+def _log_drain():
+    """Let the writer flush everything queued, then close the fd (atexit)."""
+    global _EVENTS_FD
+    if _LOG_WRITER.is_alive():
+        try:
+            _LOG_Q.put(_LOG_STOP, timeout=1)
+            _LOG_WRITER.join(timeout=5)
+        except queue.Full:
+            pass
+    batch = []
+    while True:
+        try:
+            record = _LOG_Q.get_nowait()
+        except queue.Empty:
+            break
+        if record is not _LOG_STOP:
+            batch.append(record)
+    dropped = _log_dropped_record()
+    if dropped:
+        batch.append(dropped)
+    if batch:
+        _events_write(batch)
+    with _EVENTS_LOCK:
+        if _EVENTS_FD is not None:
+            os.close(_EVENTS_FD)
+            _EVENTS_FD = None
+
+
+_LOG_WRITER = threading.Thread(target=_log_writer, name="events-writer", daemon=True)
+_LOG_WRITER.start()
+atexit.register(_log_drain)
+
+
+def log_event(event_type: str, payload: dict):
+    if event_type in LOG_SKIP_EVENTS:
+        return
+    # the timestamp is formatted by the writer thread, off the request path
+    global _LOG_DROPPED
+    try:
+        _LOG_Q.put_nowait((time.time(), event_type, payload))
+    except queue.Full:
+        _LOG_DROPPED += 1
+
+
+_DELETED = object()  # _JsonStore pending-change marker for a removed key
+
+
+FILE_LOCK_POLL_SEC = 0.02
+
+
+@contextmanager
+def _file_lock(path: str):
+    """
+    Exclusive advisory lock (flock) on path, shared by all worker processes.
+    Polls with LOCK_NB: a blocking flock would stall the whole gevent worker, including
+    the greenlet that holds the lock, while time.sleep yields to it.
+    """
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    except FileNotFoundError:
+        _ensure_data_dir(force=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(FILE_LOCK_POLL_SEC)
+        yield
+    finally:
+        os.close(fd)  # releases the lock
+
+
+class _JsonStore:
+    """
+    JSON object file parsed once and kept in memory; several worker processes may share it.
+    set()/delete() change the in-memory dict and remember the key as pending; a timer flushes
+    after STORE_FLUSH_DELAY_SEC. A flush takes <path>.lock, re-reads the file, applies only
+    this process's pending keys and writes the result atomically, so keys saved meanwhile by
+    other workers are kept. The file's mtime is checked on access: writes by other workers are
+    picked up, with this process's unflushed changes applied on top.
+    """
+
+    def __init__(self, path: str, prune=None):
+        self.path = path
+        self.prune = prune  # optional fn(data) run before each flush, e.g. to drop expired entries
+        self.lock = threading.RLock()
+        self._data = None
+        self._mtime_ns = None
+        self._pending = {}  # key -> new value or _DELETED, not yet on disk
+        self._timer = None
+
+    def _disk_mtime_ns(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load_merged(self) -> dict:
+        data = _load_json(self.path, {})
+        if not isinstance(data, dict):
+            data = {}
+        for k, v in self._pending.items():
+            if v is _DELETED:
+                data.pop(k, None)
+            else:
+                data[k] = v
+        return data
+
+    def data(self) -> dict:
+        """The current dict; read-only for callers (change it via set/delete)."""
+        with self.lock:
+            mtime_ns = self._disk_mtime_ns()
+            if self._data is None or mtime_ns != self._mtime_ns:
+                self._data = self._load_merged()
+                self._mtime_ns = mtime_ns
+            return self._data
+
+    def set(self, key: str, value):
+        with self.lock:
+            self.data()[key] = value
+            self._pending[key] = value
+            self._schedule_flush()
+
+    def delete(self, key: str):
+        with self.lock:
+            self.data().pop(key, None)
+            self._pending[key] = _DELETED
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._timer is None:
+            self._timer = threading.Timer(STORE_FLUSH_DELAY_SEC, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            try:
+                with _file_lock(self.path + ".lock"):
+                    data = self._load_merged()
+                    if self.prune is not None:
+                        self.prune(data)
+                    _save_json(self.path, data)
+                    self._mtime_ns = self._disk_mtime_ns()
+                self._data = data
+                self._pending.clear()
+            except Exception as e:
+                log_event("store_flush_error", {"path": self.path, "error": str(e)})
+
+
+def _states_prune(states: dict):
+    cutoff = int(time.time()) - STATE_TTL_SEC
+    for k in [k for k, v in states.items() if int((v or {}).get("ts", 0)) < cutoff]:
+        states.pop(k, None)
+
+
+_TOKENS_STORE = _JsonStore(TOKENS_FILE)
+_STATES_STORE = _JsonStore(STATES_FILE, prune=_states_prune)
+
+
+def _flush_stores():
+    _TOKENS_STORE.flush()
+    _STATES_STORE.flush()
+
+
+atexit.register(_flush_stores)
+
+
+def _install_sigterm_flush():
+    # Chain to the previous handler so gunicorn/werkzeug shutdown logic still runs.
+    try:
+        prev = signal.getsignal(signal.SIGTERM)
+
+        def _on_sigterm(signum, frame):
+            _flush_stores()
+            if callable(prev):
+                prev(signum, frame)
+            elif prev == signal.SIG_DFL:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, _on_sigterm)
+    except (ValueError, OSError):
+        # not in main thread / unsupported platform: atexit still covers normal exits
+        pass
+
+
+_install_sigterm_flush()
+
+
+def _states_get(state: str):
+    if not state:
         return None
-    return item
+    with _STATES_STORE.lock:
+        states = _STATES_STORE.data()
+        item = states.get(state)
+        if not item:
+            return None
+        if _now_ts() - int(item.get("ts", 0)) > STATE_TTL_SEC:
+            _STATES_STORE.delete(state)
+            return None
+        return item
 
 
 def _states_put(state: str, subdomain: str):
-    states = _load_json(STATES_FILE, {})
-    states[state] = {"subdomain": subdomain, "ts": int(time.time())}
-    _save_json(STATES_FILE, states)
+    _STATES_STORE.set(state, {"subdomain": subdomain, "ts": _now_ts()})
+
+
+# first host label, optionally after a URL scheme: "https://acme.amocrm.ru/x" / "acme.amocrm.ru:443" -> "acme"
+_SUBDOMAIN_RE = re.compile(r"(?:[a-z][a-z0-9+.-]*://)?([^.:/?#\s]+)", re.I)
 
 
 def _parse_subdomain_from_host(host: str) -> str:
     if not host:
         return ""
-    host = host.strip().split(":")[0]
-    parts = host.split(".")
-    if len(parts) >= 3 and parts[-2] == "amocrm":
-        return parts[0]
-    if "." not in host:
-        return host
-    return parts[0]
+    m = _SUBDOMAIN_RE.match(host.strip())
+    return m.group(1) if m else ""
 
 
 def _infer_subdomain_from_request() -> str:
@@ -168,14 +608,12 @@ def _infer_subdomain_from_request() -> str:
 
     hdr = request.headers.get("Referer")
     if hdr:
-        try:
-            return _parse_subdomain_from_host(urlparse(hdr).hostname or "")
-        except Exception:
-            pass
+        return _parse_subdomain_from_host(hdr)
 
     return ""
 
 
+@lru_cache(maxsize=256)
 def _amo_base_url(subdomain: str) -> str:
     sd = (subdomain or "").strip().replace("https://", "").replace("http://", "")
     sd = sd.split("/")[0]
@@ -185,17 +623,19 @@ def _amo_base_url(subdomain: str) -> str:
 
 
 def _tokens_all():
-    return _load_json(TOKENS_FILE, {})
+    # shallow copy: callers may iterate while another thread stores a token
+    with _TOKENS_STORE.lock:
+        return dict(_TOKENS_STORE.data())
 
 
 def _tokens_get(subdomain: str):
-    return _tokens_all().get(subdomain)
+    with _TOKENS_STORE.lock:
+        return _TOKENS_STORE.data().get(subdomain)
 
 
 def _tokens_set(subdomain: str, token_payload: dict):
-    all_tokens = _tokens_all()
-    all_tokens[subdomain] = token_payload
-    _save_json(TOKENS_FILE, all_tokens)
+    _TOKENS_STORE.set(subdomain, token_payload)
+    _ACCESS_TOKEN_CACHE.pop(subdomain, None)
 
 
 def _amo_token_exchange(subdomain: str, code: str):
@@ -211,11 +651,11 @@ def _amo_token_exchange(subdomain: str, code: str):
         "code": code,
         "redirect_uri": AMO_REDIRECT_URI,
     }
-    r = requests.post(url, json=payload, timeout=HTTP_TIMEOUT)
+    r = _SESSION.post(url, json=payload, timeout=HTTP_TIMEOUT)
     if not r.ok:
         raise RuntimeError(f"token_exchange_failed: {r.status_code} {r.text[:400]}")
 
-    data = r.json()
+    data = _json_loads(r.content)
     expires_in = int(data.get("expires_in", 0) or 0)
     data["expires_at"] = int(time.time()) + max(expires_in - 60, 0)
     data["base_url"] = base
@@ -232,89 +672,399 @@ def _amo_refresh_token(subdomain: str, refresh_token: str):
         "refresh_token": refresh_token,
         "redirect_uri": AMO_REDIRECT_URI,
     }
-    r = requests.post(url, json=payload, timeout=HTTP_TIMEOUT)
+    r = _SESSION.post(url, json=payload, timeout=HTTP_TIMEOUT)
     if not r.ok:
         raise RuntimeError(f"token_refresh_failed: {r.status_code} {r.text[:400]}")
 
-    data = r.json()
+    data = _json_loads(r.content)
     expires_in = int(data.get("expires_in", 0) or 0)
     data["expires_at"] = int(time.time()) + max(expires_in - 60, 0)
     data["base_url"] = base
     return data
 
 
+# Single-flight refresh per subdomain: concurrent requests share one in-flight refresh.
+_REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="amo-refresh")
+_REFRESH_INFLIGHT = {}  # subdomain -> Future
+_REFRESH_LOCK = threading.Lock()
+
+
+def _do_refresh(subdomain: str, seen: dict):
+    """
+    Refresh the token the caller read (seen). Runs under a file lock shared by all workers;
+    if the stored token no longer matches `seen`, someone already refreshed it (amo rotates
+    refresh tokens, so seen's is used up): that token is returned instead.
+    """
+    try:
+        with _file_lock(TOKENS_FILE + ".refresh.lock"):
+            current = _tokens_get(subdomain) or {}
+            if (current.get("refresh_token"), current.get("expires_at")) != (
+                seen.get("refresh_token"),
+                seen.get("expires_at"),
+            ):
+                return current
+            refreshed = _amo_refresh_token(subdomain, seen.get("refresh_token"))
+            _tokens_set(subdomain, refreshed)
+            _TOKENS_STORE.flush()  # other workers must see the new refresh token before the lock is released
+            return refreshed
+    except Exception as e:
+        log_event("token_refresh_error", {"subdomain": subdomain, "error": str(e)})
+        raise
+    finally:
+        with _REFRESH_LOCK:
+            _REFRESH_INFLIGHT.pop(subdomain, None)
+
+
+def _refresh_async(subdomain: str, tok: dict):
+    with _REFRESH_LOCK:
+        fut = _REFRESH_INFLIGHT.get(subdomain)
+        if fut is None:
+            fut = _REFRESH_EXECUTOR.submit(_do_refresh, subdomain, tok)
+            _REFRESH_INFLIGHT[subdomain] = fut
+        return fut
+
+
+# subdomain -> (access_token, use_until): skips the store lookup (lock + file stat) on hot paths.
+# use_until is capped well before the refresh-ahead window, so refresh logic still runs in time.
+ACCESS_TOKEN_CACHE_SEC = 30
+_ACCESS_TOKEN_CACHE = {}
+
+
 def _amo_get_access_token(subdomain: str) -> str:
+    now = int(time.time())
+    cached = _ACCESS_TOKEN_CACHE.get(subdomain)
+    if cached and cached[1] > now:
+        return cached[0]
+
     tok = _tokens_get(subdomain)
     if not tok:
         raise RuntimeError("not_connected: run /oauth/start and approve access")
 
-    if int(tok.get("expires_at", 0)) <= int(time.time()):
-        refreshed = _amo_refresh_token(subdomain, tok.get("refresh_token"))
-        _tokens_set(subdomain, refreshed)
-        tok = refreshed
+    expires_at = int(tok.get("expires_at", 0))
+    if expires_at <= now:
+        # expired: must wait for a fresh token
+        tok = _refresh_async(subdomain, tok).result()
+    elif expires_at - TOKEN_REFRESH_AHEAD_SEC <= now:
+        # still valid but close to expiry: refresh in background, serve current token
+        _refresh_async(subdomain, tok)
 
     access_token = tok.get("access_token")
     if not access_token:
         raise RuntimeError("token_missing_access_token")
+    use_until = min(int(tok.get("expires_at", 0)) - TOKEN_REFRESH_AHEAD_SEC, now + ACCESS_TOKEN_CACHE_SEC)
+    if use_until > now:
+        _ACCESS_TOKEN_CACHE[subdomain] = (access_token, use_until)
     return access_token
 
 
+_SWEEP_FAILED = set()  # refresh tokens the sweeper already failed with; not retried until replaced
+
+
+def _token_sweeper():
+    """Refresh tokens due within the next sweep, so requests rarely wait on (or trigger) a refresh."""
+    while True:
+        time.sleep(TOKEN_SWEEP_SEC)
+        due = int(time.time()) + TOKEN_REFRESH_AHEAD_SEC + TOKEN_SWEEP_SEC
+        tokens = _tokens_all()
+        # forget failures for refresh tokens that have since been replaced or removed
+        _SWEEP_FAILED.intersection_update({(t or {}).get("refresh_token") for t in tokens.values()})
+        for subdomain, tok in tokens.items():
+            refresh_token = (tok or {}).get("refresh_token")
+            if not refresh_token or refresh_token in _SWEEP_FAILED:
+                continue
+            if int(tok.get("expires_at", 0)) <= due:
+                _refresh_async(subdomain, tok).add_done_callback(
+                    lambda f, rt=refresh_token: _SWEEP_FAILED.add(rt) if f.exception() else None
+                )
+
+
+if TOKEN_SWEEP_SEC > 0:
+    threading.Thread(target=_token_sweeper, name="token-sweeper", daemon=True).start()
+
+
+# Per-request memo of amo GET responses: set to {} in before_request; report pool tasks run in a
+# copy of the request context (see _submit_ctx), so they share the same dict.
+_AMO_GET_MEMO = contextvars.ContextVar("amo_get_memo", default=None)
+
+
+# Request start time (unix seconds), set in before_request; 0 outside requests.
+_REQUEST_NOW = contextvars.ContextVar("request_now", default=0)
+
+
+def _now_ts() -> int:
+    """Request start time inside a request (pool tasks included), the current time elsewhere."""
+    return _REQUEST_NOW.get() or int(time.time())
+
+
+def _submit_ctx(pool, fn, *args):
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+def _amo_get_memo_key(subdomain: str, path: str, params):
+    items = []
+    for k, v in (params or {}).items():
+        items.append((k, tuple(v) if isinstance(v, list) else v))
+    return (subdomain, path, tuple(sorted(items)))
+
+
 def _amo_request(subdomain: str, method: str, path: str, params=None, json_body=None):
+    memo = _AMO_GET_MEMO.get() if method == "GET" and json_body is None else None
+    if memo is not None:
+        memo_key = _amo_get_memo_key(subdomain, path, params)
+        if memo_key in memo:
+            return memo[memo_key]
+        data = _amo_request_uncached(subdomain, method, path, params)
+        memo[memo_key] = data
+        return data
+    return _amo_request_uncached(subdomain, method, path, params, json_body)
+
+
+_AMO_SLOTS = {}  # base url -> BoundedSemaphore(AMO_MAX_CONCURRENCY)
+_PAGE_SLOTS = {}  # base url -> BoundedSemaphore(AMO_MAX_CONCURRENCY), page tasks in flight
+_AMO_SLOTS_LOCK = threading.Lock()
+
+
+def _amo_slot(base: str, slots: dict = _AMO_SLOTS):
+    with _AMO_SLOTS_LOCK:
+        sem = slots.get(base)
+        if sem is None:
+            sem = slots[base] = threading.BoundedSemaphore(AMO_MAX_CONCURRENCY)
+        return sem
+
+
+def _amo_send(subdomain: str, method: str, path: str, params=None, json_body=None, headers=None):
+    """Authorized amo call; returns the raw response (raises on 4xx/5xx)."""
     base = _amo_base_url(subdomain)
     token = _amo_get_access_token(subdomain)
     url = f"{base}{path}"
-    headers = {"Authorization": f"Bearer {token}"}
-    r = requests.request(
-        method,
-        url,
-        headers=headers,
-        params=params or {},
-        json=json_body,
-        timeout=HTTP_TIMEOUT,
-    )
+    hdrs = {"Authorization": f"Bearer {token}"}
+    if headers:
+        hdrs.update(headers)
+    with _amo_slot(base):
+        r = _SESSION.request(
+            method,
+            url,
+            headers=hdrs,
+            params=params or {},
+            json=json_body,
+            timeout=HTTP_TIMEOUT,
+        )
     if not r.ok:
         raise RuntimeError(f"amo_api_failed: {r.status_code} {r.text[:500]}")
-    if r.status_code == 204:
+    return r
+
+
+def _amo_response_json(r) -> dict:
+    if r.status_code in (204, 304):
         return {}
-    return r.json() if r.text else {}
+    return _json_loads(r.content) if r.content else {}
 
 
-def _amo_list_paged(subdomain: str, path: str, params=None, limit=DEFAULT_LIMIT, max_pages=50):
-    """Collect pages until no next link. Works with amo HAL responses."""
-    out = []
-    page = 1
-    params = dict(params or {})
-    params["limit"] = min(int(limit), 250)
-    while page <= max_pages:
-        params["page"] = page
-        data = _amo_request(subdomain, "GET", path, params=params)
-        embedded = (data.get("_embedded") or {})
-        key = None
-        for k in ("leads", "users", "pipelines", "loss_reasons", "tasks", "notes"):
-            if k in embedded:
+def _amo_request_uncached(subdomain: str, method: str, path: str, params=None, json_body=None):
+    return _amo_response_json(_amo_send(subdomain, method, path, params=params, json_body=json_body))
+
+
+# After page 1, fetch this many pages at a time (amo rate-limits per integration: keep it small)
+AMO_PAGE_PREFETCH = int(os.environ.get("AMO_PAGE_PREFETCH") or "3")
+_PAGE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="amo-page")
+
+
+def _submit_page(subdomain: str, fn, page: int):
+    # Take the account's page slot before queueing, so one account can't occupy every
+    # _PAGE_EXECUTOR thread (blocked in _amo_send) while others wait behind it.
+    sem = _amo_slot(_amo_base_url(subdomain), _PAGE_SLOTS)
+    sem.acquire()
+    try:
+        f = _submit_ctx(_PAGE_EXECUTOR, fn, page)
+    except BaseException:
+        sem.release()
+        raise
+    f.add_done_callback(lambda _f: sem.release())  # also runs on cancel()
+    return f
+
+
+def _embedded_items(data: dict, key: str = None) -> list:
+    embedded = (data.get("_embedded") or {})
+    if key:
+        return embedded.get(key) or []
+    for k in ("leads", "users", "pipelines", "loss_reasons", "tasks", "notes"):
+        if k in embedded:
+            key = k
+            break
+    if not key:
+        for k, v in embedded.items():
+            if isinstance(v, list):
                 key = k
                 break
-        if not key:
-            for k, v in embedded.items():
-                if isinstance(v, list):
-                    key = k
-                    break
-        items = embedded.get(key) if key else []
-        if items:
+    return (embedded.get(key) if key else None) or []
+
+
+def _last_page_hint(data: dict) -> int:
+    """Total pages if amo reports it (_page_count or _links.last), else 0."""
+    try:
+        n = int(data.get("_page_count") or 0)
+        if n:
+            return n
+        href = ((data.get("_links") or {}).get("last") or {}).get("href") or ""
+        if href:
+            return int((parse_qs(urlparse(href).query).get("page") or ["0"])[0])
+    except Exception:
+        pass
+    return 0
+
+
+def _amo_list_paged(
+    subdomain: str,
+    path: str,
+    params=None,
+    limit=DEFAULT_LIMIT,
+    max_pages=50,
+    embedded_key=None,
+    item_fn=None,
+    first_page=None,
+):
+    """
+    Collect pages until no next link (or a short page). Works with amo HAL responses.
+    Page 1 is fetched alone. If it tells the page count, all remaining pages are requested
+    at once; otherwise, while there is a next link, the following pages are fetched
+    AMO_PAGE_PREFETCH at a time. Results are merged in page order.
+    embedded_key names the list in _embedded (e.g. "leads"); detected per page if omitted.
+    item_fn, if given, reshapes each item as its page arrives (e.g. _report_lead), so the raw
+    page dicts are dropped page by page; such pages also skip the per-request GET memo.
+    first_page: page 1's response body if the caller already has it (same params and limit).
+    """
+    params = dict(params or {})
+    params.pop("page", None)
+    params["limit"] = per_page = min(int(limit), 250)
+    # encode filters once; each page only appends its number
+    base_qs = urlencode(params, doseq=True)
+
+    amo_get = _amo_request if item_fn is None else _amo_request_uncached
+
+    def parse(data: dict):
+        items = _embedded_items(data, embedded_key)
+        # a short page is the last one, whatever _links says
+        has_next = len(items) >= per_page and "next" in (data.get("_links") or {})
+        if item_fn is not None:
+            items = list(map(item_fn, items))
+        return items, has_next, data
+
+    def fetch(page: int):
+        return parse(amo_get(subdomain, "GET", f"{path}?{base_qs}&page={page}"))
+
+    items, has_next, first = fetch(1) if first_page is None else parse(first_page)
+    out = list(items)
+    last_page = min(_last_page_hint(first), max_pages) if has_next else 0
+    if last_page > 1:
+        futures = [_submit_page(subdomain, fetch, p) for p in range(2, last_page + 1)]
+        for f in futures:
+            out.extend(f.result()[0])
+        return out
+
+    page = 2
+    while has_next and page <= max_pages:
+        batch = range(page, min(page + AMO_PAGE_PREFETCH, max_pages + 1))
+        futures = [_submit_page(subdomain, fetch, p) for p in batch]
+        for f in futures:
+            if not has_next:
+                # past the last page: drop prefetched results
+                f.cancel()
+                continue
+            items, has_next, _ = f.result()
             out.extend(items)
-        links = data.get("_links") or {}
-        if "next" not in links:
-            break
-        page += 1
+        page += len(batch)
     return out
 
 
+# (subdomain, path) -> (fetched_at, items, etag, {id: name}); LRU-bounded by DICT_CACHE_MAX
+_DICT_CACHE = OrderedDict()
+_DICT_CACHE_LOCK = threading.Lock()
+
+
+def _id_name_map(items: list) -> dict:
+    return {i.get("id"): i.get("name") for i in items if i.get("id")}
+
+
+def _amo_list_cached(subdomain: str, path: str, embedded_key: str, refresh: bool = False, names: bool = False):
+    """
+    _amo_list_paged for small dictionaries (users, loss reasons) with a per-subdomain TTL cache.
+    Expired single-page entries are revalidated with If-None-Match when amo sent an ETag,
+    so an unchanged list costs a body-less 304.
+    names=True returns the cached {id: name} map instead of the raw items.
+    """
+    idx = 3 if names else 1
+    key = (subdomain, path)
+    with _DICT_CACHE_LOCK:
+        hit = _DICT_CACHE.get(key)
+        if hit and not refresh and time.time() - hit[0] < DICT_CACHE_TTL_SEC:
+            _DICT_CACHE.move_to_end(key)
+            return hit[idx]
+
+    # page 1 (conditional if we hold an ETag); same URL as _amo_list_paged's first page,
+    # so a multi-page list hands it over instead of fetching it again
+    cond = {"If-None-Match": hit[2]} if hit and hit[2] else None
+    r = _amo_send(subdomain, "GET", f"{path}?limit={DEFAULT_LIMIT}&page=1", headers=cond)
+    if r.status_code == 304 and hit:
+        items, etag, name_map = hit[1], hit[2], hit[3]
+    else:
+        data = _amo_response_json(r)
+        items = _embedded_items(data, embedded_key)
+        etag = r.headers.get("ETag")
+        if len(items) >= DEFAULT_LIMIT and "next" in (data.get("_links") or {}):
+            # multi-page: page 1's ETag doesn't cover the rest
+            items = _amo_list_paged(
+                subdomain, path, {}, DEFAULT_LIMIT, 10, embedded_key, first_page=data
+            )
+            etag = None
+        name_map = _id_name_map(items)
+
+    entry = (time.time(), items, etag, name_map)
+    with _DICT_CACHE_LOCK:
+        _DICT_CACHE[key] = entry
+        _DICT_CACHE.move_to_end(key)
+        while len(_DICT_CACHE) > DICT_CACHE_MAX:
+            _DICT_CACHE.popitem(last=False)
+    return entry[idx]
+
+
+def _amo_users(subdomain: str, refresh: bool = False, names: bool = False):
+    return _amo_list_cached(subdomain, "/api/v4/users", "users", refresh, names)
+
+
+def _amo_loss_reasons(subdomain: str, refresh: bool = False, names: bool = False):
+    return _amo_list_cached(subdomain, "/api/v4/leads/loss_reasons", "loss_reasons", refresh, names)
+
+
+def _amo_pipelines(subdomain: str, refresh: bool = False, names: bool = False):
+    return _amo_list_cached(subdomain, "/api/v4/leads/pipelines", "pipelines", refresh, names)
+
+
+def _lost_status_filter(subdomain: str, pipeline_id=None, refresh: bool = False) -> dict:
+    """
+    filter[statuses] params selecting only the lost status (143) of each pipeline
+    (or of pipeline_id alone), so amo doesn't send the other closed leads.
+    Empty if the pipeline list can't be fetched: callers still check status_id themselves.
+    """
+    if pipeline_id is not None:
+        pipeline_ids = [pipeline_id]
+    else:
+        try:
+            pipeline_ids = [p["id"] for p in _amo_pipelines(subdomain, refresh) if p.get("id")]
+        except Exception as e:
+            log_event("pipelines_error", {"subdomain": subdomain, "error": str(e)})
+            return {}
+    params = {}
+    for i, pid in enumerate(pipeline_ids):
+        params[f"filter[statuses][{i}][pipeline_id]"] = pid
+        params[f"filter[statuses][{i}][status_id]"] = LOST_STATUS
+    return params
+
+
 def _tg_send(text: str):
     if not (TG_BOT_TOKEN and TG_CHAT_ID):
         return {"ok": False, "error": "TG_BOT_TOKEN or TG_CHAT_ID is missing"}
     try:
-        url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMessage"
-        r = requests.post(url, json={"chat_id": TG_CHAT_ID, "text": text}, timeout=15)
+        r = _SESSION.post(TG_SEND_URL, json={"chat_id": TG_CHAT_ID, "text": text}, timeout=15)
         try:
             j = r.json()
         except Exception:
@@ -324,16 +1074,81 @@ def _tg_send(text: str):
         return {"ok": False, "error": str(e)}
 
 def send_telegram_message(text: str):
-    """Backwards-compatible helper used by install hooks."""
+    """Backwards-compatible helper: synchronous send, raises on failure."""
     res = _tg_send(text)
     if not res.get("ok"):
         raise RuntimeError(str(res))
     return res
 
+
+# Notifications from request handlers are queued and sent by one background thread,
+# so Telegram latency/outages never hold up a response.
+TG_QUEUE_MAX = 1024
+TG_SEND_ATTEMPTS = 3
+_TG_Q = queue.Queue(maxsize=TG_QUEUE_MAX)
+
+
+TG_RETRY_AFTER_MAX_SEC = 60
+
+
+def _tg_send_with_retry(text: str, attempts: int = TG_SEND_ATTEMPTS):
+    res = {}
+    for attempt in range(attempts):
+        res = _tg_send(text)
+        status = int(res.get("status") or 0)
+        if res.get("ok") or res.get("error", "").startswith("TG_BOT_TOKEN") or (400 <= status < 500 and status != 429):
+            break  # sent, not configured, or a request error that retrying won't fix
+        if attempt + 1 < attempts:
+            delay = 2 ** attempt
+            if status == 429:
+                # flood control: Telegram says how long to back off
+                params = ((res.get("response") or {}).get("parameters") or {})
+                delay = min(int(params.get("retry_after") or delay), TG_RETRY_AFTER_MAX_SEC)
+            time.sleep(delay)
+    if not res.get("ok"):
+        log_event("tg_send_error", {"result": res})
+    return res
+
+
+def _tg_worker():
+    while True:
+        _tg_send_with_retry(_TG_Q.get())
+
+
+def _tg_notify(text: str) -> bool:
+    """Fire-and-forget Telegram message. When the queue is full the oldest message is dropped."""
+    for _ in range(2):
+        try:
+            _TG_Q.put_nowait(text)
+            return True
+        except queue.Full:
+            try:
+                dropped = _TG_Q.get_nowait()
+                log_event("tg_queue_full", {"dropped": dropped[:200]})
+            except queue.Empty:
+                pass
+    return False
+
+
+def _tg_drain(budget_sec: float = 5.0):
+    """atexit: one attempt for each still-queued message, within budget_sec."""
+    deadline = time.monotonic() + budget_sec
+    while time.monotonic() < deadline:
+        try:
+            text = _TG_Q.get_nowait()
+        except queue.Empty:
+            break
+        _tg_send_with_retry(text, attempts=1)
+
+
+threading.Thread(target=_tg_worker, name="tg-sender", daemon=True).start()
+atexit.register(_tg_drain)
+
 def _to_ts(date_yyyy_mm_dd: str, end_of_day: bool = False) -> int:
     try:
-        dt = datetime.strptime(date_yyyy_mm_dd, "%Y-%m-%d")
-        ts = int(time.mktime(dt.timetuple()))
+        # day boundaries in UTC (not the server's local zone)
+        dt = datetime.strptime(date_yyyy_mm_dd, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        ts = int(dt.timestamp())
         if end_of_day:
             ts += 24 * 3600 - 1
         return ts
@@ -341,10 +1156,48 @@ def _to_ts(date_yyyy_mm_dd: str, end_of_day: bool = False) -> int:
         return 0
 
 
-def _days_since(ts: int) -> int:
+def _tail_lines(path: str, n: int, block: int = 8192) -> list:
+    """Last n lines of a file (bytes), reading backwards from the end in blocks."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b""
+        # n+1 newlines guarantee n complete lines (the file ends with "\n")
+        while pos > 0 and buf.count(b"\n") <= n:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+    return buf.splitlines()[-n:]
+
+
+def _stream_json_response(head: dict, list_key: str, items: list):
+    """
+    JSON object response sent in chunks: all `head` fields, then `list_key` as an array
+    serialized one item per chunk (the full body is never built in memory).
+    """
+    def gen():
+        prefix = _json_dumps(head)[:-1]  # drop closing "}"
+        yield prefix + (b"," if head else b"") + _json_dumps(list_key) + b":["
+        for i, item in enumerate(items):
+            yield (b"," if i else b"") + _json_dumps(item)
+        yield b"]}"
+
+    return app.response_class(gen(), mimetype="application/json")
+
+
+def _sorted_top(items: list, n: int, key) -> list:
+    """items sorted by key; only the first n when n > 0 (partial sort via heap)."""
+    if n > 0 and len(items) > n:
+        return heapq.nsmallest(n, items, key=key)
+    items.sort(key=key)
+    return items
+
+
+def _days_since(ts: int, now: int = 0) -> int:
     if not ts:
         return 0
-    return max(0, int((int(time.time()) - int(ts)) / 86400))
+    return max(0, int(((now or int(time.time())) - int(ts)) / 86400))
 
 
 def _env_mask(v: str) -> str:
@@ -374,6 +1227,46 @@ def _lead_has_open_tasks(subdomain: str, lead_id: int) -> bool:
         return True
 
 
+# ids per batched entity_id[] filter; keeps the query string well under common URL limits
+AMO_ID_BATCH = 100
+
+
+def _lead_ids_with_open_tasks(subdomain: str, lead_ids: list, pool=None) -> set:
+    """
+    Batched _lead_has_open_tasks: ids (of lead_ids) that have at least one unfinished task.
+    One paged tasks query per AMO_ID_BATCH ids; batches run on pool if given.
+    A failed batch counts all its leads as having tasks (same preference as the single check).
+    If a batch hits the page cap, leads not seen yet are checked one by one.
+    """
+    max_pages = 20
+
+    def batch_ids(batch):
+        params = {
+            "filter[entity_type]": "leads",
+            "filter[entity_id][]": batch,
+            "filter[is_completed]": 0,
+        }
+        try:
+            tasks = _amo_list_paged(subdomain, "/api/v4/tasks", params, DEFAULT_LIMIT, max_pages, "tasks")
+        except Exception:
+            return set(batch)
+        found = {t.get("entity_id") for t in tasks}
+        if len(tasks) >= min(DEFAULT_LIMIT, 250) * max_pages:
+            # capped: the remaining leads' tasks may sit on pages we didn't read
+            found |= {lid for lid in batch if lid not in found and _lead_has_open_tasks(subdomain, lid)}
+        return found
+
+    batches = [lead_ids[i:i + AMO_ID_BATCH] for i in range(0, len(lead_ids), AMO_ID_BATCH)]
+    if pool is None:
+        results = map(batch_ids, batches)
+    else:
+        results = [f.result() for f in [_submit_ctx(pool, batch_ids, b) for b in batches]]
+    out = set()
+    for ids in results:
+        out |= ids
+    return out
+
+
 def _lead_last_task_ts(subdomain: str, lead_id: int) -> int:
     """Returns timestamp (seconds) of the most recently updated task for the lead, or 0."""
     try:
@@ -432,54 +1325,143 @@ def _lead_last_event_ts(subdomain: str, lead_id: int) -> int:
 
 
 
-def _lead_last_activity_ts(subdomain: str, lead: dict) -> int:
+def _lead_stale_activity_ts(subdomain: str, lead, stale_ts_cutoff: int, open_task_ids=None):
     """
-    We treat 'activity' as max of:
-    - last note created_at
-    - last task updated_at/created_at
-    - lead.updated_at (fallback)
+    Deep stale check for one lead: "нет задач + нет активностей (notes/tasks/events) > N дней".
+    Returns last activity ts (may be 0) if the lead is stale, otherwise None.
+
+    Activity is max of lead.updated_at, last task updated_at/created_at, last note, last relevant event.
+    Lookups go cheapest-first and stop as soon as one shows recent activity.
+    open_task_ids: result of _lead_ids_with_open_tasks, if already fetched for a batch of leads.
     """
-    lead_id = int(lead.get("id") or 0)
-    ts = int(lead.get("updated_at") or 0)
+    lid = lead.id
+    if stale_ts_cutoff < lead.updated_at:
+        return None
+
+    # If open tasks exist => NOT stale
+    if lid in open_task_ids if open_task_ids is not None else _lead_has_open_tasks(subdomain, lid):
+        return None
+
+    last_act = lead.updated_at
+    for lookup in (_lead_last_task_ts, _lead_last_note_ts, _lead_last_event_ts):
+        ts = int(lookup(subdomain, lid) or 0)
+        if ts > stale_ts_cutoff:
+            return None
+        last_act = max(last_act, ts)
+    return last_act
 
-    lt = _lead_last_task_ts(subdomain, lead_id)
-    ln = _lead_last_note_ts(subdomain, lead_id)
 
-    return max(ts, lt, ln)
+# Lead fields used by reports, cast once when the lead arrives from amo.
+ReportLead = namedtuple(
+    "ReportLead",
+    "id name price responsible_user_id status_id pipeline_id loss_reason_id updated_at",
+)
+
+
+@dataclass(slots=True)
+class LeadOut:
+    """One lead in the dashboard payload (slotted: many of these per report)."""
+
+    id: int
+    name: str
+    price: int
+    responsible_user_id: int
+    responsible_name: str
+    status_id: int
+    pipeline_id: int
+    loss_reason_id: int
+    loss_reason: str
+    updated_at: int
+    last_activity_ts: int
+    days_no_activity: int
+    url: str
+
+
+class _ManagerBuckets(dict):
+    """responsible_user_id -> report bucket for that manager, created on first access."""
+
+    def __init__(self, user_name: dict):
+        super().__init__()
+        self.user_name = user_name
+
+    def __missing__(self, uid):
+        pm = self[uid] = {
+            "manager_id": uid,
+            "manager_name": self.user_name.get(uid) or str(uid),
+            "lost_count": 0,
+            "lost_sum": 0,
+            "lost_by_reason": {},  # reason_name -> {count,sum}
+            "lost_leads": [],
+            "stale_count": 0,
+            "stale_sum": 0,
+            "stale_leads": [],
+        }
+        return pm
+
+
+def _report_lead(l: dict) -> ReportLead:
+    lid = int(l.get("id") or 0)
+    return ReportLead(
+        lid,
+        l.get("name") or f"Сделка #{lid}",
+        int(l.get("price") or 0),
+        l.get("responsible_user_id"),
+        int(l.get("status_id") or 0),
+        l.get("pipeline_id"),
+        l.get("loss_reason_id"),
+        int(l.get("updated_at") or 0),
+    )
 
 
 # =========================
 # Routes
 # =========================
+@app.before_request
+def _request_scope_start():
+    _REQUEST_NOW.set(int(time.time()))
+    _AMO_GET_MEMO.set({})
+
+
+@app.teardown_request
+def _request_scope_end(exc=None):
+    _REQUEST_NOW.set(0)
+    _AMO_GET_MEMO.set(None)
+
+
+# Fixed bodies are serialized once at import
+_INDEX_BODY = _json_dumps(
+    {
+        "ok": True,
+        "service": "loss-control-backend",
+        "data_dir": DATA_DIR,
+        "endpoints": [
+            "/health (GET)",
+            "/debug/last (GET)",
+            "/debug/tokens (GET)",
+            "/debug/env (GET)",
+            "/debug/tg_test (POST)",
+            "/widget/ping (POST)",
+            "/widget/install (POST)",
+            "/oauth/start (GET)",
+            "/oauth/callback (GET/POST)",
+            "/api/users (GET)",
+            "/api/loss_reasons (GET)",
+            "/api/lead/set_loss_reason (POST)",
+            "/report/dashboard (GET)",
+        ],
+    }
+)
+_HEALTH_BODY = _json_dumps({"ok": True})
+
+
 @app.get("/")
 def index():
-    return jsonify(
-        {
-            "ok": True,
-            "service": "loss-control-backend",
-            "data_dir": DATA_DIR,
-            "endpoints": [
-                "/health (GET)",
-                "/debug/last (GET)",
-                "/debug/tokens (GET)",
-                "/debug/env (GET)",
-                "/debug/tg_test (POST)",
-                "/widget/ping (POST)",
-                "/widget/install (POST)",
-                "/oauth/start (GET)",
-                "/oauth/callback (GET/POST)",
-                "/api/users (GET)",
-                "/api/loss_reasons (GET)",
-                "/api/lead/set_loss_reason (POST)",
-                "/report/dashboard (GET)",
-            ],
-        }
-    )
+    return app.response_class(_INDEX_BODY, mimetype="application/json")
 
 
 @app.get("/health")
 def health():
-    return jsonify({"ok": True})
+    return app.response_class(_HEALTH_BODY, mimetype="application/json")
 
 
 # 1x1 transparent GIF (CORS-free install tracking)
@@ -489,11 +1471,26 @@ GIF_1x1 = (
     b"\x00\x02\x02D\x01\x00;"
 )
 
+# Telegram text for widget installs (plain text, no parse_mode: user fields need no escaping)
+INSTALL_TG_TEMPLATE = (
+    "✅ Установка виджета 'Контроль потерь'\n"
+    "Subdomain: {subdomain}\n"
+    "ФИО: {contact_name}\n"
+    "Email: {contact_email}\n"
+    "Телефон: {contact_phone}\n"
+    "Backend URL: {backend_url}"
+)
+
+
+def _install_message(payload: dict) -> str:
+    return INSTALL_TG_TEMPLATE.format_map({k: v or "-" for k, v in payload.items()})
+
+
 @app.get("/widget/install.gif")
 def widget_install_gif():
     """
     CORS-free install tracking via <img src="...">.
-    Sends Telegram notification best-effort and returns 1x1 gif.
+    Queues Telegram notification (best-effort) and returns 1x1 gif.
     """
     subdomain = (request.args.get("subdomain") or "").strip()
     contact_name = (request.args.get("name") or "").strip()
@@ -506,32 +1503,22 @@ def widget_install_gif():
         "contact_email": contact_email,
         "contact_phone": contact_phone,
         "backend_url": backend_url,
-        "ts": int(time.time()),
+        "ts": _now_ts(),
     }
     log_event("install_gif", payload)
     try:
-        msg = (
-            "✅ Установка виджета 'Контроль потерь'\n"
-            f"Subdomain: {subdomain or '-'}\n"
-            f"ФИО: {contact_name or '-'}\n"
-            f"Email: {contact_email or '-'}\n"
-            f"Телефон: {contact_phone or '-'}\n"
-            f"Backend URL: {backend_url or '-'}"
-        )
-        send_telegram_message(msg)
+        _tg_notify(_install_message(payload))
     except Exception as e:
         log_event("install_gif_tg_error", {"error": str(e)})
 
-    from flask import Response
-    return Response(GIF_1x1, mimetype="image/gif")
+    return app.response_class(GIF_1x1, mimetype="image/gif")
 
 
 @app.get("/debug/last")
 def debug_last():
     try:
-        with open(EVENTS_FILE, "r", encoding="utf-8") as f:
-            lines = f.readlines()[-120:]
-        return jsonify({"ok": True, "lines": [l.strip() for l in lines]})
+        lines = _tail_lines(EVENTS_FILE, 120)
+        return jsonify({"ok": True, "lines": [l.decode("utf-8", "replace").strip() for l in lines]})
     except Exception:
         return jsonify({"ok": True, "lines": []})
 
@@ -615,21 +1602,13 @@ def widget_install():
         "contact_email": contact_email,
         "contact_phone": contact_phone,
         "backend_url": backend_url,
-        "ts": int(time.time()),
+        "ts": _now_ts(),
     }
     log_event("install", payload)
 
-    # Telegram notify (best-effort)
+    # Telegram notify (best-effort, sent in background)
     try:
-        msg = (
-            "✅ Установка виджета 'Контроль потерь'\n"
-            f"Subdomain: {subdomain or '-'}\n"
-            f"ФИО: {contact_name or '-'}\n"
-            f"Email: {contact_email or '-'}\n"
-            f"Телефон: {contact_phone or '-'}\n"
-            f"Backend URL: {backend_url or '-'}"
-        )
-        send_telegram_message(msg)
+        _tg_notify(_install_message(payload))
     except Exception as e:
         log_event("install_tg_error", {"error": str(e)})
 
@@ -637,6 +1616,17 @@ def widget_install():
 
 
 
+# /oauth/start page; only the target URL varies per request
+OAUTH_REDIRECT_HTML = """<!doctype html><html><head><meta charset="utf-8">
+<meta http-equiv="refresh" content="0;url={target}">
+<title>Redirecting…</title></head>
+<body style="font-family:Arial,sans-serif;padding:20px">
+Перенаправляю на amoCRM…<br>
+Если не открылось автоматически, нажмите: <a href="{target}">Продолжить</a>
+<script>window.location.replace({target_js});</script>
+</body></html>"""
+
+
 @app.get("/oauth/start")
 def oauth_start():
     """
@@ -659,16 +1649,8 @@ def oauth_start():
         params = {"client_id": AMO_CLIENT_ID, "state": state, "mode": "popup"}
         target = url + "?" + urlencode(params)
 
-        html = f"""<!doctype html><html><head><meta charset="utf-8">
-<meta http-equiv="refresh" content="0;url={target}">
-<title>Redirecting…</title></head>
-<body style="font-family:Arial,sans-serif;padding:20px">
-Перенаправляю на amoCRM…<br>
-Если не открылось автоматически, нажмите: <a href="{target}">Продолжить</a>
-<script>window.location.replace({target!r});</script>
-</body></html>"""
-        from flask import Response
-        return Response(html, mimetype="text/html")
+        html = OAUTH_REDIRECT_HTML.format(target=target, target_js=repr(target))
+        return app.response_class(html, mimetype="text/html")
     except Exception as e:
         log_event("oauth_start_error", {"error": str(e)})
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -689,6 +1671,13 @@ def oauth_start():
         log_event("oauth_start_error", {"error": str(e)})
         return jsonify({"ok": False, "error": str(e)}), 500
 
+_OAUTH_OK_HTML = (
+    "<html><body style='font-family:Arial'>"
+    "<h2>Аккаунт подключен ✅</h2>"
+    "Можно закрыть окно.</body></html>"
+).encode("utf-8")
+
+
 @app.route("/oauth/callback", methods=["GET","POST"])
 def oauth_callback():
     code = (request.args.get("code") or "").strip() or (request.form.get("code") or "").strip()
@@ -714,13 +1703,7 @@ def oauth_callback():
         tok = _amo_token_exchange(subdomain, code)
         _tokens_set(subdomain, tok)
         log_event("oauth_ok", {"subdomain": subdomain, "referer": request.args.get("referer")})
-        return (
-            "<html><body style='font-family:Arial'>"
-            "<h2>Аккаунт подключен ✅</h2>"
-            "Можно закрыть окно.</body></html>",
-            200,
-            {"Content-Type": "text/html; charset=utf-8"},
-        )
+        return _OAUTH_OK_HTML, 200, {"Content-Type": "text/html; charset=utf-8"}
 
     except Exception as e:
         log_event("oauth_error", {"subdomain": subdomain, "error": str(e), "args": dict(request.args)})
@@ -735,7 +1718,7 @@ def api_users():
         return jsonify({"ok": False, "error": "missing_subdomain"}), 400
 
     try:
-        users = _amo_list_paged(subdomain, "/api/v4/users", params={}, limit=DEFAULT_LIMIT, max_pages=10)
+        users = _amo_users(subdomain, refresh=request.args.get("refresh") == "1")
         simplified = [{"id": u.get("id"), "name": u.get("name")} for u in users if u.get("id")]
         return jsonify({"ok": True, "users": simplified})
     except Exception as e:
@@ -749,7 +1732,7 @@ def api_loss_reasons():
         return jsonify({"ok": False, "error": "missing_subdomain"}), 400
 
     try:
-        reasons = _amo_list_paged(subdomain, "/api/v4/leads/loss_reasons", params={}, limit=DEFAULT_LIMIT, max_pages=10)
+        reasons = _amo_loss_reasons(subdomain, refresh=request.args.get("refresh") == "1")
         simplified = [{"id": r.get("id"), "name": r.get("name")} for r in reasons if r.get("id")]
         return jsonify({"ok": True, "reasons": simplified})
     except Exception as e:
@@ -776,8 +1759,100 @@ def api_set_loss_reason():
 
 
 # ---------- Reports ----------
+# query key -> (expires_at, body bytes); LRU-bounded by REPORT_CACHE_MAX
+_REPORT_CACHE = OrderedDict()
+_REPORT_INFLIGHT = {}  # query key -> Event set when the computing request finishes
+_REPORT_LOCK = threading.Lock()
+
+
 @app.get("/report/dashboard")
 def report_dashboard():
+    """
+    _report_dashboard with a short-TTL cache of the serialized body per query string
+    (the response still streams; the body is cached after it was sent in full).
+    Concurrent identical requests wait for the first one instead of all hitting amo.
+    ?nocache=1 (or ?refresh=1) recomputes and replaces the entry.
+    """
+    if REPORT_CACHE_TTL_SEC <= 0:
+        return _report_dashboard()
+
+    skip = ("nocache", "refresh")
+    key = tuple(sorted((k, v) for k, v in request.args.items(multi=True) if k not in skip))
+    bypass = request.args.get("nocache") == "1" or request.args.get("refresh") == "1"
+    ev, owner = None, False
+    if not bypass:
+        for _ in range(2):
+            with _REPORT_LOCK:
+                hit = _REPORT_CACHE.get(key)
+                if hit and hit[0] > time.time():
+                    _REPORT_CACHE.move_to_end(key)
+                    return app.response_class(hit[1], mimetype="application/json")
+                ev = _REPORT_INFLIGHT.get(key)
+                if ev is None:
+                    ev = _REPORT_INFLIGHT[key] = threading.Event()
+                    owner = True
+                    break
+            # someone else is computing this report: wait for it, then re-check the cache
+            ev.wait(HTTP_TIMEOUT * 2)
+
+    def release():
+        if owner:
+            with _REPORT_LOCK:
+                _REPORT_INFLIGHT.pop(key, None)
+            ev.set()
+
+    try:
+        resp = _report_dashboard()
+    except BaseException:
+        release()
+        raise
+    if isinstance(resp, tuple) or resp.status_code != 200:
+        release()
+        return resp
+    # stream to the client as before; the chunks are cached once the body was sent in full
+    resp.response = _ReportCacheBody(resp.response, key, release)
+    return resp
+
+
+class _ReportCacheBody:
+    """
+    Response iterable that passes chunks through and keeps a copy. On close() (always
+    called by the WSGI server) a fully sent body goes into _REPORT_CACHE and waiters are released.
+    """
+
+    def __init__(self, chunks, key, release):
+        self._chunks = chunks
+        self._key = key
+        self._release = release
+        self._parts = []
+        self._done = False
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self._parts.append(chunk)
+            yield chunk
+        self._done = True
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is None:
+            return
+        try:
+            if self._done:
+                body = b"".join(self._parts)
+                with _REPORT_LOCK:
+                    _REPORT_CACHE[self._key] = (time.time() + REPORT_CACHE_TTL_SEC, body)
+                    _REPORT_CACHE.move_to_end(self._key)
+                    while len(_REPORT_CACHE) > REPORT_CACHE_MAX:
+                        _REPORT_CACHE.popitem(last=False)
+            if hasattr(self._chunks, "close"):
+                self._chunks.close()
+        finally:
+            self._parts = []
+            release()
+
+
+def _report_dashboard():
     """
     Returns:
     - lost deals (status_id=143) for date range, grouped by manager and reason
@@ -786,192 +1861,194 @@ def report_dashboard():
     subdomain = (request.args.get("subdomain") or "").strip()
     date_from = (request.args.get("date_from") or "").strip()
     date_to = (request.args.get("date_to") or "").strip()
-    stale_days = int(request.args.get("stale_days") or "7")
     manager_id = (request.args.get("manager_id") or "").strip()
     pipeline_id = (request.args.get("pipeline_id") or "").strip()
+    # compared against the int ids amo returns; a non-numeric filter simply matches nothing
+    manager_uid = (int(manager_id) if manager_id.isdigit() else manager_id) if manager_id else None
+    pipeline_uid = (int(pipeline_id) if pipeline_id.isdigit() else pipeline_id) if pipeline_id else None
+    refresh = request.args.get("refresh") == "1"
+    try:
+        stale_days = int(request.args.get("stale_days") or "7")
+        top_n = int(request.args.get("top_n") or "0")  # max leads per manager list, 0 = all
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad_params", "details": "stale_days and top_n must be integers"}), 400
 
     if not subdomain:
         return jsonify({"ok": False, "error": "missing_subdomain"}), 400
 
     ts_from = _to_ts(date_from) if date_from else 0
     ts_to = _to_ts(date_to, end_of_day=True) if date_to else 0
-    stale_ts_cutoff = int(time.time()) - stale_days * 86400
+    now_ts = _now_ts()
+    stale_ts_cutoff = now_ts - stale_days * 86400
 
     warnings = []
 
     try:
-        # dictionaries for names
-        users = _amo_list_paged(subdomain, "/api/v4/users", params={}, limit=DEFAULT_LIMIT, max_pages=10)
-        user_name = {u.get("id"): u.get("name") for u in users if u.get("id")}
-
-        reasons = _amo_list_paged(subdomain, "/api/v4/leads/loss_reasons", params={}, limit=DEFAULT_LIMIT, max_pages=10)
-        reason_name = {r.get("id"): r.get("name") for r in reasons if r.get("id")}
-
-        # -------- lost leads --------
-        params_lost = {}
-        if ts_from:
-            params_lost["filter[closed_at][from]"] = ts_from
-        if ts_to:
-            params_lost["filter[closed_at][to]"] = ts_to
-
-        closed = _amo_list_paged(subdomain, "/api/v4/leads", params=params_lost, limit=DEFAULT_LIMIT, max_pages=20)
-
-        lost_leads = []
-        for l in closed:
-            if int(l.get("status_id") or 0) != 143:
-                continue
-            if manager_id and str(l.get("responsible_user_id")) != manager_id:
-                continue
-            if pipeline_id and str(l.get("pipeline_id")) != pipeline_id:
-                continue
-            lost_leads.append(l)
-
-        # -------- stale candidates --------
-        # 1) cheap prefilter: updated_at <= cutoff (same as v1), then we do deep check
-        params_stale_prefilter = {"filter[updated_at][to]": stale_ts_cutoff}
-        maybe_stale = _amo_list_paged(subdomain, "/api/v4/leads", params=params_stale_prefilter, limit=DEFAULT_LIMIT, max_pages=20)
-
-        candidates = []
-        for l in maybe_stale:
-            sid = int(l.get("status_id") or 0)
-            if sid in (142, 143):  # closed win/loss
-                continue
-            if manager_id and str(l.get("responsible_user_id")) != manager_id:
-                continue
-            if pipeline_id and str(l.get("pipeline_id")) != pipeline_id:
-                continue
-            candidates.append(l)
-
-        # 2) deep check: "нет задач + нет активностей (notes/tasks) > N дней"
-        stale_leads = []
-        deep = candidates[:MAX_STALE_ACTIVITY_CHECK]
-        if len(candidates) > MAX_STALE_ACTIVITY_CHECK:
-            warnings.append(
-                f"Слишком много потенциально зависших сделок ({len(candidates)}). "
-                f"Для точной проверки задач/заметок обработано только первые {MAX_STALE_ACTIVITY_CHECK}. "
-                f"Увеличьте MAX_STALE_ACTIVITY_CHECK в Render env, если нужно."
+        pool = ThreadPoolExecutor(max_workers=REPORT_FETCH_WORKERS)
+        try:
+            # independent paged fetches run concurrently
+            params_lost = {}
+            if ts_from:
+                params_lost["filter[closed_at][from]"] = ts_from
+            if ts_to:
+                params_lost["filter[closed_at][to]"] = ts_to
+            # cheap prefilter for stale: updated_at <= cutoff (same as v1), then we do deep check
+            params_stale_prefilter = {"filter[updated_at][to]": stale_ts_cutoff}
+            # manager/pipeline filters are applied by amo too, so non-matching leads aren't transferred
+            # (the loops below still check them)
+            for params in (params_lost, params_stale_prefilter):
+                if isinstance(manager_uid, int):
+                    params["filter[responsible_user_id]"] = manager_uid
+                if isinstance(pipeline_uid, int):
+                    params["filter[pipeline_id]"] = pipeline_uid
+
+            f_users = _submit_ctx(pool, _amo_users, subdomain, refresh, True)
+            f_reasons = _submit_ctx(pool, _amo_loss_reasons, subdomain, refresh, True)
+
+            def fetch_lost():
+                params = dict(params_lost)
+                status_filter = _lost_status_filter(
+                    subdomain, pipeline_uid if isinstance(pipeline_uid, int) else None, refresh
+                )
+                if status_filter:
+                    # statuses already pin the pipeline(s)
+                    params.pop("filter[pipeline_id]", None)
+                    params.update(status_filter)
+                return _amo_list_paged(subdomain, "/api/v4/leads", params, DEFAULT_LIMIT, 20, "leads", _report_lead)
+
+            f_closed = _submit_ctx(pool, fetch_lost)
+            f_stale = _submit_ctx(
+                pool,
+                _amo_list_paged,
+                subdomain,
+                "/api/v4/leads",
+                params_stale_prefilter,
+                DEFAULT_LIMIT,
+                20,
+                "leads",
+                _report_lead,
             )
 
-        for l in deep:
-            lid = int(l.get("id") or 0)
-            # If open tasks exist => NOT stale
-            if _lead_has_open_tasks(subdomain, lid):
-                continue
-
-            last_basic = _lead_last_activity_ts(subdomain, l)
-            if last_basic and last_basic > stale_ts_cutoff:
-                continue
-
-            # Extra check: also treat Events as activity (calls/chat/sms/notes/tasks/etc.)
-            last_evt = _lead_last_event_ts(subdomain, lid)
-            last_act = max(int(last_basic or 0), int(last_evt or 0))
-
-            if last_act and last_act > stale_ts_cutoff:
-                continue
-
-            # stale
-            l["_lc_last_activity_ts"] = last_act
-            stale_leads.append(l)
+            # dictionaries for names (cached alongside the lists; read-only here)
+            user_name = f_users.result()
+            reason_name = f_reasons.result()
+
+            # -------- lost leads --------
+            closed = f_closed.result()
+
+            def narrow(leads: list) -> list:
+                # optional filters (amo applies them too); tested once, not per lead
+                if manager_uid is not None:
+                    leads = [l for l in leads if l.responsible_user_id == manager_uid]
+                if pipeline_uid is not None:
+                    leads = [l for l in leads if l.pipeline_id == pipeline_uid]
+                return leads
+
+            lost_leads = narrow([l for l in closed if l.status_id == LOST_STATUS])
+
+            # -------- stale candidates --------
+            maybe_stale = f_stale.result()
+            candidates = narrow([l for l in maybe_stale if l.status_id not in CLOSED_STATUSES])
+
+            # deep check per lead (tasks/notes/events), leads checked concurrently
+            stale_leads = []
+            deep = candidates[:MAX_STALE_ACTIVITY_CHECK]
+            if len(candidates) > MAX_STALE_ACTIVITY_CHECK:
+                warnings.append(
+                    f"Слишком много потенциально зависших сделок ({len(candidates)}). "
+                    f"Для точной проверки задач/заметок обработано только первые {MAX_STALE_ACTIVITY_CHECK}. "
+                    f"Увеличьте MAX_STALE_ACTIVITY_CHECK в Render env, если нужно."
+                )
+
+            # open tasks for all deep-checked leads in a few batched queries
+            deep = [l for l in deep if l.updated_at <= stale_ts_cutoff]
+            open_task_ids = _lead_ids_with_open_tasks(subdomain, [l.id for l in deep], pool)
+            deep = [l for l in deep if l.id not in open_task_ids]
+            checked = [
+                _submit_ctx(pool, _lead_stale_activity_ts, subdomain, l, stale_ts_cutoff, open_task_ids) for l in deep
+            ]
+            for l, f in zip(deep, checked):
+                last_act = f.result()
+                if last_act is None:
+                    continue
+                # stale
+                stale_leads.append((l, last_act))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
 
         # group by manager
-        def pack_lead(l, kind: str):
-            lid = l.get("id")
-            last_act = int(l.get("_lc_last_activity_ts") or l.get("updated_at") or 0)
-            return {
-                "id": lid,
-                "name": l.get("name") or f"Сделка #{lid}",
-                "price": int(l.get("price") or 0),
-                "responsible_user_id": l.get("responsible_user_id"),
-                "responsible_name": user_name.get(l.get("responsible_user_id")) or str(l.get("responsible_user_id")),
-                "status_id": l.get("status_id"),
-                "pipeline_id": l.get("pipeline_id"),
-                "loss_reason_id": l.get("loss_reason_id"),
-                "loss_reason": reason_name.get(l.get("loss_reason_id"), "—") if kind == "lost" else None,
-                "updated_at": l.get("updated_at"),
-                "last_activity_ts": last_act,
-                "days_no_activity": _days_since(last_act),
-                "url": f"{_amo_base_url(subdomain)}/leads/detail/{lid}",
-            }
-
-        per_manager = {}
-
-        # lost aggregation
-        for l in lost_leads:
-            uid = l.get("responsible_user_id")
-            key = str(uid)
-            pm = per_manager.setdefault(
-                key,
-                {
-                    "manager_id": uid,
-                    "manager_name": user_name.get(uid) or str(uid),
-                    "lost_count": 0,
-                    "lost_sum": 0,
-                    "lost_by_reason": {},  # reason_name -> {count,sum}
-                    "lost_leads": [],
-                    "stale_count": 0,
-                    "stale_sum": 0,
-                    "stale_leads": [],
-                },
+        lead_url_prefix = f"{_amo_base_url(subdomain)}/leads/detail/"
+
+        def pack_lead(l: ReportLead, responsible_name: str, loss_reason=None, last_act: int = 0):
+            # names are resolved by the caller (bucket / reason lookup it already did)
+            lid = l.id
+            last_act = last_act or l.updated_at
+            return LeadOut(
+                lid,
+                l.name,
+                l.price,
+                l.responsible_user_id,
+                responsible_name,
+                l.status_id,
+                l.pipeline_id,
+                l.loss_reason_id,
+                loss_reason,
+                l.updated_at,
+                last_act,
+                _days_since(last_act, now_ts),
+                f"{lead_url_prefix}{lid}",
             )
-            price = int(l.get("price") or 0)
-            pm["lost_count"] += 1
-            pm["lost_sum"] += price
-            rname = reason_name.get(l.get("loss_reason_id"), "Без причины")
-            rb = pm["lost_by_reason"].setdefault(rname, {"count": 0, "sum": 0})
-            rb["count"] += 1
-            rb["sum"] += price
-            pm["lost_leads"].append(pack_lead(l, "lost"))
-
-        # stale aggregation
-        for l in stale_leads:
-            uid = l.get("responsible_user_id")
-            key = str(uid)
-            pm = per_manager.setdefault(
-                key,
-                {
-                    "manager_id": uid,
-                    "manager_name": user_name.get(uid) or str(uid),
-                    "lost_count": 0,
-                    "lost_sum": 0,
-                    "lost_by_reason": {},
-                    "lost_leads": [],
-                    "stale_count": 0,
-                    "stale_sum": 0,
-                    "stale_leads": [],
-                },
-            )
-            price = int(l.get("price") or 0)
-            pm["stale_count"] += 1
-            pm["stale_sum"] += price
-            pm["stale_leads"].append(pack_lead(l, "stale"))
 
-        # format lost_by_reason to list
-        managers_list = []
+        per_manager = _ManagerBuckets(user_name)
+        reason_get = reason_name.get
+
+        # one pass over lost + stale leads
+        tagged = itertools.chain(
+            ((l, "lost", 0) for l in lost_leads),
+            ((l, "stale", last_act) for l, last_act in stale_leads),
+        )
+        for l, kind, last_act in tagged:
+            pm = per_manager[l.responsible_user_id]
+            price = l.price
+            if kind == "lost":
+                pm["lost_count"] += 1
+                pm["lost_sum"] += price
+                lrid = l.loss_reason_id
+                rname = reason_get(lrid, "Без причины")
+                rb = pm["lost_by_reason"].get(rname)
+                if rb is None:
+                    rb = pm["lost_by_reason"][rname] = {"count": 0, "sum": 0}
+                rb["count"] += 1
+                rb["sum"] += price
+                pm["lost_leads"].append(pack_lead(l, pm["manager_name"], reason_get(lrid, "—")))
+            else:
+                pm["stale_count"] += 1
+                pm["stale_sum"] += price
+                pm["stale_leads"].append(pack_lead(l, pm["manager_name"], None, last_act))
+
+        # format lost_by_reason to list; totals and the manager sort key in the same pass
+        totals = {"lost_count": 0, "lost_sum": 0, "stale_count": 0, "stale_sum": 0}
+        decorated = []
         for pm in per_manager.values():
-            reasons_list = [{"reason": k, "count": v["count"], "sum": v["sum"]} for k, v in pm["lost_by_reason"].items()]
-            reasons_list.sort(key=lambda x: (-x["sum"], -x["count"], x["reason"]))
-            pm["lost_by_reason"] = reasons_list
-            pm["lost_leads"].sort(key=lambda x: (-x["price"], x["id"]))
-            pm["stale_leads"].sort(key=lambda x: (-x["price"], -x["days_no_activity"], x["id"]))
-            managers_list.append(pm)
-
-        managers_list.sort(
-            key=lambda x: (
-                -(x["lost_sum"] + x["stale_sum"]),
-                -(x["lost_count"] + x["stale_count"]),
-                x["manager_name"],
+            reasons_list = sorted((-v["sum"], -v["count"], k) for k, v in pm["lost_by_reason"].items())
+            pm["lost_by_reason"] = [{"reason": k, "count": -c, "sum": -sm} for sm, c, k in reasons_list]
+            pm["lost_leads"] = _sorted_top(pm["lost_leads"], top_n, key=lambda x: (-x.price, x.id))
+            pm["stale_leads"] = _sorted_top(
+                pm["stale_leads"], top_n, key=lambda x: (-x.price, -x.days_no_activity, x.id)
             )
-        )
+            totals["lost_count"] += pm["lost_count"]
+            totals["lost_sum"] += pm["lost_sum"]
+            totals["stale_count"] += pm["stale_count"]
+            totals["stale_sum"] += pm["stale_sum"]
+            sort_key = (-(pm["lost_sum"] + pm["stale_sum"]), -(pm["lost_count"] + pm["stale_count"]), pm["manager_name"])
+            decorated.append((sort_key, len(decorated), pm))
+        decorated.sort()
+        managers_list = [pm for _, _, pm in decorated]
 
-        totals = {
-            "lost_count": sum(m["lost_count"] for m in managers_list),
-            "lost_sum": sum(m["lost_sum"] for m in managers_list),
-            "stale_count": sum(m["stale_count"] for m in managers_list),
-            "stale_sum": sum(m["stale_sum"] for m in managers_list),
-        }
         totals["total_risk_sum"] = totals["lost_sum"] + totals["stale_sum"]
 
-        return jsonify(
+        # managers (the bulk of the payload) are streamed one by one after the header fields
+        return _stream_json_response(
             {
                 "ok": True,
                 "subdomain": subdomain,
@@ -980,11 +2057,13 @@ def report_dashboard():
                 "stale_days": stale_days,
                 "manager_id": manager_id or None,
                 "pipeline_id": pipeline_id or None,
+                "top_n": top_n or None,
                 "totals": totals,
-                "managers": managers_list,
                 "warnings": warnings,
                 "note": "stale=v2: no open tasks + no open tasks + no notes/tasks/events activity within N days; prefilter by lead.updated_at.",
-            }
+            },
+            "managers",
+            managers_list,
         )
 
     except Exception as e:
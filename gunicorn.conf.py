@@ -0,0 +1,20 @@
+# Loaded automatically by `gunicorn app:app` from the working directory.
+import os
+
+bind = "0.0.0.0:" + (os.environ.get("PORT") or "5000")
+
+# gevent workers yield while waiting on amo/Telegram HTTP calls, so one worker
+# serves many slow /report/dashboard requests at once (gunicorn patches before loading app).
+worker_class = "gevent"
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS") or "1000")
+
+# Token/state files are merged under a file lock, so workers don't overwrite each other's saves;
+# caches and token refresh single-flight are still per process: keep a single worker unless
+# WEB_CONCURRENCY says otherwise.
+workers = int(os.environ.get("WEB_CONCURRENCY") or "1")
+
+# Reports can take a while on big accounts (paged amo fetches + deep stale checks).
+timeout = int(os.environ.get("GUNICORN_TIMEOUT") or "120")
+graceful_timeout = 30
+keepalive = 30
+max_requests = 0